@@ -0,0 +1,204 @@
+"""
+Attract mode: streams animations and images from disk onto the sign while waiting for players.
+
+Frames go through a generator pipeline: files are found, decoded and fitted to the sign on a
+background thread, then handed over through a bounded buffer as finished pixel data. Showing a
+frame is then just copying it into the sign's packet and sending it.
+
+Images are binary PPM (P6) files. A file can hold several images one after another, which is what
+`ffmpeg -i video.mp4 -s 512x32 -f image2pipe -vcodec ppm out.ppm` produces; those are played as an
+animation. Files with a single image are shown as a still.
+"""
+
+from queue import Queue, Empty, Full
+import os
+import threading
+
+EXTENSIONS = ('.ppm', '.pnm')
+
+# Sending pure black to a sign that isn't transparent turns the pixel off entirely; like
+# Flaschen.set, show it as the dimmest gray instead
+_NO_BLACK = bytes([1]) + bytes(range(1, 256))
+
+
+def frame_files(directory):
+    """
+    Endlessly cycle through the image files in a directory, picking up changes on every pass.
+    :param directory: The directory to read
+    :return: Generator of file paths; stops if there are no images
+    """
+    while True:
+        try:
+            names = sorted(name for name in os.listdir(directory) if name.lower().endswith(EXTENSIONS))
+        except OSError:
+            return
+
+        if not names:
+            return
+
+        for name in names:
+            yield os.path.join(directory, name)
+
+
+def _token(f):
+    """Read one whitespace-separated PPM header token, skipping comments."""
+    token = b''
+    while True:
+        c = f.read(1)
+        if not c:
+            break
+        if c == b'#':
+            f.readline()
+            if token:
+                break
+        elif c.isspace():
+            if token:
+                break
+        else:
+            token += c
+    return token
+
+
+def read_ppm(path):
+    """
+    Read every image in a PPM file, one at a time.
+    :param path: The file to read
+    :return: Generator of (width, height, pixels) with pixels as packed RGB bytes
+    """
+    with open(path, 'rb') as f:
+        while True:
+            magic = _token(f)
+            if not magic:
+                return
+            if magic != b'P6':
+                raise ValueError("{} is not a binary PPM file".format(path))
+
+            # The single whitespace after maxval is consumed by _token
+            width, height, maxval = int(_token(f)), int(_token(f)), int(_token(f))
+            if maxval != 255:
+                raise ValueError("{} has {} levels per color; only 255 is supported".format(path, maxval))
+
+            pixels = f.read(width * height * 3)
+            if len(pixels) < width * height * 3:
+                return
+            yield width, height, pixels
+
+
+def fit(pixels, width, height, sign_width, sign_height):
+    """
+    Crop or pad an image to the size of the sign, anchored at the top left.
+    :return: Exactly sign_width * sign_height * 3 bytes
+    """
+    if width == sign_width and height == sign_height:
+        return pixels
+
+    out = bytearray(sign_width * sign_height * 3)
+    row = min(width, sign_width) * 3
+    for y in range(min(height, sign_height)):
+        src = y * width * 3
+        dst = y * sign_width * 3
+        out[dst:dst + row] = pixels[src:src + row]
+    return bytes(out)
+
+
+def frames(directory, sign_width, sign_height, fps, hold, transparent=True):
+    """
+    The full decode pipeline: every image in the directory, ready to send.
+    :param directory:   Directory of PPM files
+    :param sign_width:  Width of the sign in pixels
+    :param sign_height: Height of the sign in pixels
+    :param fps:         Frame rate for animations
+    :param hold:        Seconds to show a still image for
+    :param transparent: Whether black is transparent on the sign; if not, it is made dark gray
+    :return: Generator of (pixels, seconds to show them); stops after a whole pass over the
+             directory without a single frame
+    """
+    # Files that gave no frames, with the (mtime, size) they had then, so they are only read
+    # and complained about again once they change
+    bad = {}
+    # Files seen since the last frame; coming back to one of them means a full pass was wasted
+    barren = set()
+
+    for path in frame_files(directory):
+        if path in barren:
+            return
+        barren.add(path)
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        version = stat.st_mtime_ns, stat.st_size
+        if bad.get(path) == version:
+            continue
+
+        try:
+            images = read_ppm(path)
+            pending = next(images, None)
+            if pending is None:
+                raise ValueError("{} has no complete images".format(path))
+
+            bad.pop(path, None)
+            barren.clear()
+            duration = hold
+            for image in images:
+                duration = 1 / fps
+                yield _encode(pending, sign_width, sign_height, transparent), duration
+                pending = image
+            yield _encode(pending, sign_width, sign_height, transparent), duration
+        except (OSError, ValueError) as e:
+            # Only if nothing at all was shown from it
+            if path in barren:
+                bad[path] = version
+            print("Skipping attract file:", e)
+
+
+def _encode(image, sign_width, sign_height, transparent):
+    width, height, pixels = image
+    pixels = fit(pixels, width, height, sign_width, sign_height)
+    if not transparent:
+        pixels = pixels.translate(_NO_BLACK)
+    return pixels
+
+
+class Prefetcher:
+    """Runs a frame generator on a background thread, keeping up to `size` frames ready."""
+
+    def __init__(self, source, size):
+        """
+        :param source: Iterable of frames
+        :param size:   Most frames to hold at once
+        """
+        self.done = False
+        self._queue = Queue(maxsize=size)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(source,), daemon=True)
+        self._thread.start()
+
+    def _run(self, source):
+        try:
+            for item in source:
+                while not self._stopped.is_set():
+                    try:
+                        self._queue.put(item, timeout=.1)
+                        break
+                    except Full:
+                        pass
+                if self._stopped.is_set():
+                    return
+        finally:
+            self.done = True
+
+    def get(self):
+        """
+        Take the next frame without waiting.
+        :return: The next frame, or None if none is ready
+        """
+        try:
+            return self._queue.get_nowait()
+        except Empty:
+            return None
+
+    def stop(self):
+        """Stop reading ahead. The thread exits within a fraction of a second."""
+        self._stopped.set()
@@ -13,8 +13,134 @@
 # along with this program.  If not, see <http://gnu.org/licenses/gpl-2.0.txt>
 
 import socket
+import threading
+import time
 
-class Flaschen(object):
+class Sprite(object):
+  '''A block of pixels that can be drawn onto a display in one go.'''
+
+  def __init__(self, width, height, pixels):
+    '''
+
+    Args:
+      width: The width of the sprite in pixels.
+      height: The height of the sprite in pixels.
+      pixels: width * height * 3 bytes of packed (r, g, b) values, row by row.
+        Black (0, 0, 0) pixels are not drawn unless the sprite is blitted opaque.
+    '''
+    self.width = width
+    self.height = height
+    self.pixels = bytes(pixels)
+    # Runs of non-black pixels in each row as (start, end) byte offsets, so a transparent blit
+    # copies whole runs instead of checking pixels one at a time
+    self.runs = []
+    stride = width * 3
+    for y in range(height):
+      row = self.pixels[y * stride:(y + 1) * stride]
+      runs = []
+      start = None
+      for x in range(width):
+        lit = row[x * 3:x * 3 + 3] != b'\0\0\0'
+        if lit and start is None:
+          start = x * 3
+        elif not lit and start is not None:
+          runs.append((start, x * 3))
+          start = None
+      if start is not None:
+        runs.append((start, stride))
+      self.runs.append(runs)
+
+
+class Canvas(object):
+  '''A frame of pixels in memory to draw on.'''
+
+  def __init__(self, width, height, transparent=False):
+    '''
+
+    Args:
+      width: The width of the canvas in pixels.
+      height: The height of the canvas in pixels.
+      transparent: If true, black(0, 0, 0) will be transparent and show the layer below.
+    '''
+    self.width = width
+    self.height = height
+    self.transparent = transparent
+    self._data = bytearray(width * height * 3)
+    self._header_len = 0
+    # A whole frame of what clear() leaves behind; see set() for why it isn't always black
+    self._blank = (b'\0\0\0' if transparent else b'\1\1\1') * (width * height)
+
+  def set(self, x, y, color):
+    '''Set the pixel at the given coordinates to the specified color.
+
+    Args:
+      x: x offset of the pixel to set
+      y: y offset of the piyel to set
+      color: A 3 tuple of (r, g, b) color values, 0-255
+    '''
+    if x >= self.width or y >= self.height or x < 0 or y < 0:
+      return
+    if color == (0, 0, 0) and not self.transparent:
+      color = (1, 1, 1)
+
+    offset = (x + y * self.width) * 3 + self._header_len
+    self._data[offset] = color[0]
+    self._data[offset + 1] = color[1]
+    self._data[offset + 2] = color[2]
+
+  def set_frame(self, pixels):
+    '''Replace every pixel at once with an already encoded frame.
+
+    Args:
+      pixels: width * height * 3 bytes of packed (r, g, b) values, row by row
+    '''
+    self._data[self._header_len:self._header_len + len(pixels)] = pixels
+
+  def blit(self, sprite, x, y, opaque=False):
+    '''Draw a sprite with its top left corner at the given coordinates.
+
+    Each row of the sprite is copied with a slice rather than pixel by pixel, and parts that
+    fall off the display are clipped.
+
+    Args:
+      sprite: The Sprite to draw
+      x: x offset of the left edge of the sprite, may be negative
+      y: y offset of the top edge of the sprite, may be negative
+      opaque: If true, black pixels in the sprite are drawn too, covering what was there
+    '''
+    left = max(0, -x) * 3
+    right = min(sprite.width, self.width - x) * 3
+    top = max(0, -y)
+    bottom = min(sprite.height, self.height - y)
+    if left >= right or top >= bottom:
+      return
+
+    stride = sprite.width * 3
+    pixels = sprite.pixels
+
+    if opaque and left == 0 and right == stride == self.width * 3:
+      # Full-width rows are contiguous on the display too, so it's all one copy
+      dst = (y + top) * stride + self._header_len
+      self._data[dst:dst + (bottom - top) * stride] = pixels[top * stride:bottom * stride]
+      return
+
+    for row in range(top, bottom):
+      src = row * stride
+      dst = ((y + row) * self.width + x) * 3 + self._header_len
+      if opaque:
+        self._data[dst + left:dst + right] = pixels[src + left:src + right]
+      else:
+        for start, end in sprite.runs[row]:
+          start = max(start, left)
+          end = min(end, right)
+          if start < end:
+            self._data[dst + start:dst + end] = pixels[src + start:src + end]
+
+  def clear(self):
+    self.set_frame(self._blank)
+
+
+class Flaschen(Canvas):
   '''A Framebuffer display interface that sends a frame via UDP.'''
 
   def __init__(self, host, port, width, height, layer=0, transparent=False):
@@ -28,10 +154,8 @@ class Flaschen(object):
       layer: The layer of the flaschen taschen display to write to.
       transparent: If true, black(0, 0, 0) will be transparent and show the layer below.
     '''
-    self.width = width
-    self.height = height
+    super(Flaschen, self).__init__(width, height, transparent)
     self.layer = layer
-    self.transparent = transparent
     self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     self._sock.connect((host, port))
     header = ''.join(["P6\n",
@@ -45,29 +169,304 @@ class Flaschen(object):
     self._data[-1 * len(footer):] = footer
     self._header_len = len(header)
 
-  def set(self, x, y, color):
-    '''Set the pixel at the given coordinates to the specified color.
+  def send(self):
+    '''Send the updated pixels to the display.'''
+    self._sock.send(self._data)
+
+
+class Target(object):
+  '''One flaschen taschen server a FanOut sends to, and how well that has been going.'''
+
+  def __init__(self, host, port, layer=0, x=0, y=0):
+    '''
 
     Args:
-      x: x offset of the pixel to set
-      y: y offset of the piyel to set
-      color: A 3 tuple of (r, g, b) color values, 0-255
+      host: The flaschen taschen server hostname or ip address.
+      port: The flaschen taschen server port number.
+      layer: The layer of the flaschen taschen display to write to.
+      x: x offset on the display to draw the frame at.
+      y: y offset on the display to draw the frame at.
     '''
-    if x >= self.width or y >= self.height or x < 0 or y < 0:
-      return
-    if color == (0, 0, 0) and not self.transparent:
-      color = (1, 1, 1)
+    self.host = host
+    self.port = port
+    self.layer = layer
+    self.x = x
+    self.y = y
+    self.footer = ''.join(["%d\n" % x,
+                           "%d\n" % y,
+                           "%d\n" % layer]).encode('utf-8')
+    self.sent = 0
+    self.dropped = 0
+    self.skipped = 0
+    self.failures = 0
+    self.last_error = None
+    self.retry_at = 0
+    # The numeric (ip, port) the host resolved to, once it has
+    self.address = None
+    self._lookup = None
+    self._sock = None
 
-    offset = (x + y * self.width) * 3 + self._header_len
-    self._data[offset] = color[0]
-    self._data[offset + 1] = color[1]
-    self._data[offset + 2] = color[2]
+  @property
+  def healthy(self):
+    return not self.failures
+
+  def resolve(self):
+    '''Find the address to send to, without ever waiting on DNS.
+
+    IP addresses are used as they are. Hostnames are looked up on a background thread, and the
+    result is kept until a send fails.
+
+    Returns:
+      The numeric (ip, port), or None while the lookup is still running.
+
+    Raises:
+      OSError: The lookup failed; calling this again starts a new one.
+    '''
+    if self.address is not None:
+      return self.address
+
+    if self._lookup is None:
+      try:
+        self.address = self._getaddrinfo(socket.AI_NUMERICHOST)
+        return self.address
+      except socket.gaierror:
+        pass
+      self._lookup = _Lookup(self._getaddrinfo)
+
+    if self._lookup.is_alive():
+      return None
+
+    lookup, self._lookup = self._lookup, None
+    if lookup.error is not None:
+      raise lookup.error
+    self.address = lookup.address
+    return self.address
+
+  def _getaddrinfo(self, flags=0):
+    return socket.getaddrinfo(self.host, self.port, socket.AF_INET, socket.SOCK_DGRAM, 0,
+                              flags)[0][4]
+
+  def send(self, buffers):
+    '''Send one frame as a single datagram gathered from several buffers.
+
+    Returns:
+      True if it was sent, False if the host hasn't been resolved yet.
+    '''
+    if self._sock is None:
+      # Resolving and connecting happen here rather than up front so a host that is down
+      # when the game starts is retried like one that goes down later
+      address = self.resolve()
+      if address is None:
+        return False
+      sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      try:
+        sock.connect(address)
+      except OSError:
+        sock.close()
+        raise
+      sock.setblocking(False)
+      self._sock = sock
+
+    if hasattr(self._sock, 'sendmsg'):
+      self._sock.sendmsg(buffers)
+    else:
+      self._sock.send(b''.join(buffers))
+    return True
+
+  def succeeded(self):
+    if self.failures:
+      print("Display %s:%d is back after %d failures" % (self.host, self.port, self.failures))
+    self.sent += 1
+    self.failures = 0
+    self.last_error = None
+
+  def failed(self, error, now, backoff, max_backoff):
+    '''Record a failed send and stop trying for a while, longer each time it fails in a row.'''
+    if not self.failures:
+      print("Display %s:%d is down: %s" % (self.host, self.port, error))
+    self.dropped += 1
+    self.failures += 1
+    self.last_error = error
+    self.retry_at = now + min(max_backoff, backoff * 2 ** (self.failures - 1))
+    if self._sock is not None:
+      self._sock.close()
+      self._sock = None
+    # The host may have moved; look it up again on the next try
+    self.address = None
+
+
+class _Lookup(threading.Thread):
+  '''Runs one blocking address lookup in the background.'''
+
+  def __init__(self, getaddrinfo):
+    super(_Lookup, self).__init__(daemon=True)
+    self._getaddrinfo = getaddrinfo
+    self.address = None
+    self.error = None
+    self.start()
+
+  def run(self):
+    try:
+      self.address = self._getaddrinfo()
+    except OSError as e:
+      self.error = e
+
+
+class FanOut(Canvas):
+  '''A display that sends every frame to several flaschen taschen servers, layers or offsets.
+
+  The frame is encoded once; each target gets the same header and pixels with its own footer,
+  gathered into a datagram without copying. Sends don't block, so a slow or dead target can't
+  hold up the others, and one that fails is left alone for a while before being tried again.
+  '''
+
+  def __init__(self, targets, width, height, transparent=False, backoff=1.0, max_backoff=30.0):
+    '''
+
+    Args:
+      targets: The Targets to send to.
+      width: The width of the frame in pixels.
+      height: The height of the frame in pixels.
+      transparent: If true, black(0, 0, 0) will be transparent and show the layer below.
+      backoff: Seconds to wait before retrying a target after it first fails.
+      max_backoff: Most seconds to wait between retries of a target that keeps failing.
+    '''
+    super(FanOut, self).__init__(width, height, transparent)
+    self.targets = list(targets)
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self._header = ''.join(["P6\n",
+                            "%d %d\n" % (self.width, self.height),
+                            "255\n"]).encode('utf-8')
+    self._pixels = memoryview(self._data)
 
-  def clear(self):
-    for y in range(self.height):
-      for x in range(self.width):
-        self.set(x, y, (0, 0, 0))
-  
   def send(self):
-    '''Send the updated pixels to the display.'''
-    self._sock.send(self._data)
+    '''Send the updated pixels to every target that isn't backed off.'''
+    now = time.monotonic()
+    for target in self.targets:
+      if now < target.retry_at:
+        target.skipped += 1
+        continue
+
+      try:
+        sent = target.send([self._header, self._pixels, target.footer])
+      except BlockingIOError:
+        # The local send buffer is full; lose this frame, the next one replaces it anyway
+        target.dropped += 1
+      except OSError as e:
+        target.failed(e, now, self.backoff, self.max_backoff)
+      else:
+        if sent:
+          target.succeeded()
+        else:
+          target.skipped += 1
+
+
+def fit_scale(width, height, display_width, display_height):
+  '''The Viewport scale that shows all of a canvas as large as possible on a display.'''
+  if width <= display_width and height <= display_height:
+    return max(1, min(display_width // width, display_height // height))
+  return -max(-(-width // display_width), -(-height // display_height))
+
+
+class Viewport(Canvas):
+  '''A canvas of any size, shown on a display with integer scaling and panning.
+
+  Scaling works on whole rows with slices and big-integer bitwise operations. The number of
+  Python-level steps per frame grows with the display height and the scale factor, not with the
+  area of the canvas; copying the canvas bytes themselves still grows with it, but happens in C.
+  '''
+
+  def __init__(self, display, width, height, scale=None):
+    '''
+
+    Args:
+      display: The Flaschen (or other Canvas with a send() method) to show the canvas on.
+      width: The width of the canvas.
+      height: The height of the canvas.
+      scale: A positive n draws every canvas pixel as n x n display pixels; a negative -n
+        shrinks every n x n block of canvas pixels to one display pixel. Defaults to the
+        largest scale at which the whole canvas fits.
+    '''
+    super(Viewport, self).__init__(width, height, display.transparent)
+    self.display = display
+    self.scale = scale or fit_scale(width, height, display.width, display.height)
+    if self.scale == -1:
+      self.scale = 1
+    self.x = 0
+    self.y = 0
+
+  def pan(self, x, y):
+    '''Choose the canvas pixel shown at the top left corner of the display.
+
+    Args:
+      x: x offset into the canvas
+      y: y offset into the canvas
+    '''
+    self.x = max(0, min(x, self.width - 1))
+    self.y = max(0, min(y, self.height - 1))
+
+  def compose(self):
+    '''Draw the visible part of the canvas onto the display, without sending it.'''
+    self.display.clear()
+    if self.scale > 0:
+      self._enlarge(self.scale)
+    else:
+      self._shrink(-self.scale)
+
+  def send(self):
+    '''Send the canvas to the display.'''
+    self.compose()
+    self.display.send()
+
+  def _enlarge(self, n):
+    display = self.display
+    cols = min(self.width - self.x, -(-display.width // n))
+    rows = min(self.height - self.y, -(-display.height // n))
+    out = min(cols * n, display.width) * 3
+    line = bytearray(cols * n * 3)
+
+    for row in range(rows):
+      src = ((self.y + row) * self.width + self.x) * 3
+      cells = self._data[src:src + cols * 3]
+      if n == 1:
+        line = cells
+      else:
+        # Every nth pixel, starting at each of the first n, is a copy of the canvas row
+        for copy in range(n):
+          for channel in range(3):
+            line[copy * 3 + channel::n * 3] = cells[channel::3]
+
+      for y in range(row * n, min((row + 1) * n, display.height)):
+        dst = y * display.width * 3 + display._header_len
+        display._data[dst:dst + out] = line[:out]
+
+  def _shrink(self, n):
+    display = self.display
+    cols = min(display.width, -(-(self.width - self.x) // n))
+    rows = min(display.height, -(-(self.height - self.y) // n))
+    span = cols * n * 3
+    available = (self.width - self.x) * 3
+    line = bytearray(cols * 3)
+
+    for row in range(rows):
+      # OR together every pixel in the n x n block by treating rows and strided slices as big
+      # integers: first the n canvas rows, then the n pixels of each block in that, one color
+      # channel at a time. A one pixel wide trail still shows up, which it wouldn't if every nth
+      # pixel were simply picked.
+      rows_or = 0
+      for y in range(self.y + row * n, min(self.y + (row + 1) * n, self.height)):
+        src = (y * self.width + self.x) * 3
+        rows_or |= int.from_bytes(self._data[src:src + min(span, available)].ljust(span, b'\0'), 'big')
+      block = rows_or.to_bytes(span, 'big')
+
+      channels = [0, 0, 0]
+      for offset in range(n):
+        for channel in range(3):
+          channels[channel] |= int.from_bytes(block[offset * 3 + channel::n * 3], 'big')
+
+      for channel in range(3):
+        line[channel::3] = channels[channel].to_bytes(cols, 'big')
+
+      dst = row * display.width * 3 + display._header_len
+      display._data[dst:dst + cols * 3] = line
@@ -0,0 +1,213 @@
+# -*- mode: python; c-basic-offset: 2; indent-tabs-mode: nil; -*-
+'''A built-in 5x7 bitmap font for drawing text on a Flaschen display.
+
+Rendered glyphs and strings are cached as flaschen.Sprite objects, so showing the same text again
+(every frame of a flashing banner, say) is just a blit.
+'''
+
+import functools
+
+import flaschen
+
+GLYPH_WIDTH = 5
+GLYPH_HEIGHT = 7
+
+# Printable ASCII from ' ' to '~'. Each glyph is 5 columns, left to right; bit 0 of a column is
+# the top row.
+_FONT = bytes([
+  0x00, 0x00, 0x00, 0x00, 0x00,  # ' '
+  0x00, 0x00, 0x5f, 0x00, 0x00,  # !
+  0x00, 0x07, 0x00, 0x07, 0x00,  # "
+  0x14, 0x7f, 0x14, 0x7f, 0x14,  # #
+  0x24, 0x2a, 0x7f, 0x2a, 0x12,  # $
+  0x23, 0x13, 0x08, 0x64, 0x62,  # %
+  0x36, 0x49, 0x55, 0x22, 0x50,  # &
+  0x00, 0x05, 0x03, 0x00, 0x00,  # '
+  0x00, 0x1c, 0x22, 0x41, 0x00,  # (
+  0x00, 0x41, 0x22, 0x1c, 0x00,  # )
+  0x08, 0x2a, 0x1c, 0x2a, 0x08,  # *
+  0x08, 0x08, 0x3e, 0x08, 0x08,  # +
+  0x00, 0x50, 0x30, 0x00, 0x00,  # ,
+  0x08, 0x08, 0x08, 0x08, 0x08,  # -
+  0x00, 0x60, 0x60, 0x00, 0x00,  # .
+  0x20, 0x10, 0x08, 0x04, 0x02,  # /
+  0x3e, 0x51, 0x49, 0x45, 0x3e,  # 0
+  0x00, 0x42, 0x7f, 0x40, 0x00,  # 1
+  0x42, 0x61, 0x51, 0x49, 0x46,  # 2
+  0x21, 0x41, 0x45, 0x4b, 0x31,  # 3
+  0x18, 0x14, 0x12, 0x7f, 0x10,  # 4
+  0x27, 0x45, 0x45, 0x45, 0x39,  # 5
+  0x3c, 0x4a, 0x49, 0x49, 0x30,  # 6
+  0x01, 0x71, 0x09, 0x05, 0x03,  # 7
+  0x36, 0x49, 0x49, 0x49, 0x36,  # 8
+  0x06, 0x49, 0x49, 0x29, 0x1e,  # 9
+  0x00, 0x36, 0x36, 0x00, 0x00,  # :
+  0x00, 0x56, 0x36, 0x00, 0x00,  # ;
+  0x08, 0x14, 0x22, 0x41, 0x00,  # <
+  0x14, 0x14, 0x14, 0x14, 0x14,  # =
+  0x00, 0x41, 0x22, 0x14, 0x08,  # >
+  0x02, 0x01, 0x51, 0x09, 0x06,  # ?
+  0x32, 0x49, 0x79, 0x41, 0x3e,  # @
+  0x7e, 0x11, 0x11, 0x11, 0x7e,  # A
+  0x7f, 0x49, 0x49, 0x49, 0x36,  # B
+  0x3e, 0x41, 0x41, 0x41, 0x22,  # C
+  0x7f, 0x41, 0x41, 0x22, 0x1c,  # D
+  0x7f, 0x49, 0x49, 0x49, 0x41,  # E
+  0x7f, 0x09, 0x09, 0x09, 0x01,  # F
+  0x3e, 0x41, 0x49, 0x49, 0x7a,  # G
+  0x7f, 0x08, 0x08, 0x08, 0x7f,  # H
+  0x00, 0x41, 0x7f, 0x41, 0x00,  # I
+  0x20, 0x40, 0x41, 0x3f, 0x01,  # J
+  0x7f, 0x08, 0x14, 0x22, 0x41,  # K
+  0x7f, 0x40, 0x40, 0x40, 0x40,  # L
+  0x7f, 0x02, 0x0c, 0x02, 0x7f,  # M
+  0x7f, 0x04, 0x08, 0x10, 0x7f,  # N
+  0x3e, 0x41, 0x41, 0x41, 0x3e,  # O
+  0x7f, 0x09, 0x09, 0x09, 0x06,  # P
+  0x3e, 0x41, 0x51, 0x21, 0x5e,  # Q
+  0x7f, 0x09, 0x19, 0x29, 0x46,  # R
+  0x46, 0x49, 0x49, 0x49, 0x31,  # S
+  0x01, 0x01, 0x7f, 0x01, 0x01,  # T
+  0x3f, 0x40, 0x40, 0x40, 0x3f,  # U
+  0x1f, 0x20, 0x40, 0x20, 0x1f,  # V
+  0x3f, 0x40, 0x38, 0x40, 0x3f,  # W
+  0x63, 0x14, 0x08, 0x14, 0x63,  # X
+  0x07, 0x08, 0x70, 0x08, 0x07,  # Y
+  0x61, 0x51, 0x49, 0x45, 0x43,  # Z
+  0x00, 0x7f, 0x41, 0x41, 0x00,  # [
+  0x02, 0x04, 0x08, 0x10, 0x20,  # backslash
+  0x00, 0x41, 0x41, 0x7f, 0x00,  # ]
+  0x04, 0x02, 0x01, 0x02, 0x04,  # ^
+  0x40, 0x40, 0x40, 0x40, 0x40,  # _
+  0x00, 0x01, 0x02, 0x04, 0x00,  # `
+  0x20, 0x54, 0x54, 0x54, 0x78,  # a
+  0x7f, 0x48, 0x44, 0x44, 0x38,  # b
+  0x38, 0x44, 0x44, 0x44, 0x20,  # c
+  0x38, 0x44, 0x44, 0x48, 0x7f,  # d
+  0x38, 0x54, 0x54, 0x54, 0x18,  # e
+  0x08, 0x7e, 0x09, 0x01, 0x02,  # f
+  0x0c, 0x52, 0x52, 0x52, 0x3e,  # g
+  0x7f, 0x08, 0x04, 0x04, 0x78,  # h
+  0x00, 0x44, 0x7d, 0x40, 0x00,  # i
+  0x20, 0x40, 0x44, 0x3d, 0x00,  # j
+  0x7f, 0x10, 0x28, 0x44, 0x00,  # k
+  0x00, 0x41, 0x7f, 0x40, 0x00,  # l
+  0x7c, 0x04, 0x18, 0x04, 0x78,  # m
+  0x7c, 0x08, 0x04, 0x04, 0x78,  # n
+  0x38, 0x44, 0x44, 0x44, 0x38,  # o
+  0x7c, 0x14, 0x14, 0x14, 0x08,  # p
+  0x08, 0x14, 0x14, 0x18, 0x7c,  # q
+  0x7c, 0x08, 0x04, 0x04, 0x08,  # r
+  0x48, 0x54, 0x54, 0x54, 0x20,  # s
+  0x04, 0x3f, 0x44, 0x40, 0x20,  # t
+  0x3c, 0x40, 0x40, 0x20, 0x7c,  # u
+  0x1c, 0x20, 0x40, 0x20, 0x1c,  # v
+  0x3c, 0x40, 0x30, 0x40, 0x3c,  # w
+  0x44, 0x28, 0x10, 0x28, 0x44,  # x
+  0x0c, 0x50, 0x50, 0x50, 0x3c,  # y
+  0x44, 0x64, 0x54, 0x4c, 0x44,  # z
+  0x00, 0x08, 0x36, 0x41, 0x00,  # {
+  0x00, 0x00, 0x7f, 0x00, 0x00,  # |
+  0x00, 0x41, 0x36, 0x08, 0x00,  # }
+  0x08, 0x04, 0x08, 0x10, 0x08,  # ~
+])
+
+_FIRST = ord(' ')
+_LAST = ord('~')
+
+
+def glyph_rows(char, color, scale=1):
+  '''Render one character.
+
+  Args:
+    char: The character; anything outside printable ASCII is drawn as '?'
+    color: (r, g, b) color values, 0-255, as a tuple or a list
+    scale: Size of each font pixel, in display pixels
+
+  Returns:
+    A tuple of GLYPH_HEIGHT * scale rows, each GLYPH_WIDTH * scale * 3 bytes.
+  '''
+  # The cache needs hashable arguments
+  return _glyph_rows(char, tuple(color), scale)
+
+
+@functools.lru_cache(maxsize=1024)
+def _glyph_rows(char, color, scale):
+  code = ord(char)
+  if code < _FIRST or code > _LAST:
+    code = ord('?')
+  columns = _FONT[(code - _FIRST) * GLYPH_WIDTH:(code - _FIRST + 1) * GLYPH_WIDTH]
+
+  on = bytes(color) * scale
+  off = b'\0\0\0' * scale
+  rows = []
+  for bit in range(GLYPH_HEIGHT):
+    row = b''.join(on if column >> bit & 1 else off for column in columns)
+    rows.extend([row] * scale)
+  return tuple(rows)
+
+
+def text(string, color, scale=1, spacing=1):
+  '''Render a line of text.
+
+  Args:
+    string: The text to render
+    color: (r, g, b) color values, 0-255, as a tuple or a list
+    scale: Size of each font pixel, in display pixels
+    spacing: Blank font pixels between characters
+
+  Returns:
+    A flaschen.Sprite of the text, with a transparent background.
+  '''
+  # The cache needs hashable arguments
+  return _text(string, tuple(color), scale, spacing)
+
+
+@functools.lru_cache(maxsize=256)
+def _text(string, color, scale, spacing):
+  if not string:
+    return flaschen.Sprite(0, GLYPH_HEIGHT * scale, b'')
+
+  gap = b'\0\0\0' * spacing * scale
+  glyphs = [_glyph_rows(char, color, scale) for char in string]
+  rows = [gap.join(glyph[row] for glyph in glyphs) for row in range(GLYPH_HEIGHT * scale)]
+  width = len(rows[0]) // 3
+  return flaschen.Sprite(width, len(rows), b''.join(rows))
+
+
+def text_width(string, scale=1, spacing=1):
+  '''Width in pixels that text() will render a string at.'''
+  if not string:
+    return 0
+  return (len(string) * (GLYPH_WIDTH + spacing) - spacing) * scale
+
+
+class Ticker(object):
+  '''Scrolls a sprite across the display, wrapping around, without re-rendering it.'''
+
+  def __init__(self, sprite, speed=1, gap=32):
+    '''
+
+    Args:
+      sprite: The Sprite to scroll, usually from text()
+      speed: Pixels to move left per frame
+      gap: Blank pixels between the end of the sprite and its next repeat
+    '''
+    self.sprite = sprite
+    self.speed = speed
+    self.period = sprite.width + gap
+    self.offset = 0
+
+  def draw(self, fb, y, opaque=False):
+    '''Draw the ticker at its current position and advance it for the next frame.
+
+    Args:
+      fb: The Flaschen to draw on
+      y: y offset of the top of the ticker
+      opaque: Passed on to Flaschen.blit
+    '''
+    x = -self.offset
+    while x < fb.width:
+      fb.blit(self.sprite, x, y, opaque)
+      x += self.period
+    self.offset = (self.offset + self.speed) % self.period
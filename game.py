@@ -7,8 +7,13 @@ from autobahn.asyncio.wamp import ApplicationSession, ApplicationRunner
 from autobahn.wamp import auth
 from collections import deque
 import itertools
+import attract
 import flaschen
+import font
+import spectator
 import asyncio
+import os
+import pickle
 import random
 import time
 
@@ -94,14 +99,51 @@ GAME_JOIN_SEQUENCE = "uuuddba"
 # - concerts
 GAME_JOIN_LOCATION = None
 
-WIDTH = 512
-HEIGHT = 32
+# Size of the sign in pixels
+SIGN_WIDTH = 512
+SIGN_HEIGHT = 32
+
+# Where to show the game, as (host, port, layer, x offset, y offset). Every display gets the same
+# frame. One that stops answering is skipped for a while so it can't hold up the others.
+DISPLAYS = [
+    ('scootaloo.hackafe.net', 1337, 16, 0, 0),
+]
+
+# Size of the board in cells. If it isn't the size of the sign, the board is scaled to fit it:
+# VIEWPORT_SCALE = n shows each cell as n x n pixels, -n shows each n x n block of cells as one
+# pixel, and None picks the largest scale that shows the whole board.
+WIDTH = SIGN_WIDTH
+HEIGHT = SIGN_HEIGHT
+VIEWPORT_SCALE = None
 
 TORUS_H = False
 TORUS_V = False
 
 TICK_RATE = 24
 
+# While waiting for players, animations and images from this directory are played on the sign.
+# See attract.py for the file format. Set to None to just show the joined players.
+ATTRACT_DIR = 'attract'
+ATTRACT_FPS = TICK_RATE
+# Seconds to show a still image for
+ATTRACT_HOLD = 5
+# Frames decoded ahead of time
+ATTRACT_PREFETCH = 2 * TICK_RATE
+
+# The game state is saved here every SNAPSHOT_INTERVAL seconds so that a restart can pick up
+# where it left off, even mid-round. Snapshots older than SNAPSHOT_MAX_AGE seconds are ignored.
+# Set SNAPSHOT_PATH to None to turn this off.
+SNAPSHOT_PATH = 'game-state.pickle'
+SNAPSHOT_INTERVAL = 1
+SNAPSHOT_MAX_AGE = 60
+# Bump when the snapshot contents change; snapshots from other versions are ignored
+SNAPSHOT_VERSION = 1
+
+# Spectators get a full keyframe at least this often (in frames) so late joiners can catch up
+SPECTATOR_KEYFRAME_INTERVAL = 2 * TICK_RATE
+# Spectators asking for a keyframe get one no more often than this (in frames)
+SPECTATOR_MIN_KEYFRAME_GAP = TICK_RATE // 2
+
 DOT_COLORS = [Color.BLUE, Color.RED, Color.GREEN, Color.PURPLE, Color.CYAN, Color.ORANGE, Color.YELLOW, Color.PINK, Color.WHITE]
 
 def dxdy_to_dir(dx, dy):
@@ -308,6 +350,7 @@ class Portal(Entity):
 
 
 POWERUPS = [JumpPowerup, SpeedPowerup, PortalPowerup]
+POWERUP_KINDS = [powerup(0, 0).kind for powerup in POWERUPS]
 
 
 class PlayerInfo:
@@ -356,6 +399,11 @@ class PlayerInfo:
         self.trail = deque()#maxlen=100 + self.wins * 6 + self.plays * 4)
         self.trail.append(initial_pos)
 
+        # Running totals of cells added to and eaten from the trail, so the spectator stream
+        # can send just the difference each tick
+        self.appended = 1
+        self.removed = 0
+
         self.dead = False
 
         self.brightness = .1
@@ -369,6 +417,7 @@ class PlayerInfo:
         for _ in range(max(self.maxlen // 30, 1)):
             if self.trail:
                 self.trail.popleft()
+                self.removed += 1
 
     def nommed(self):
         return not bool(self.trail)
@@ -471,6 +520,7 @@ class PlayerInfo:
                 powerup.consume()
 
         self.trail.append(npos)
+        self.appended += 1
         self.moved = False
 
     def draw(self, fb):
@@ -484,8 +534,121 @@ class PlayerInfo:
 
             fb.set(x, y, color)
 
+# What is saved of each object in a snapshot, besides positions and links to other objects
+_PLAYER_FIELDS = ('wins', 'plays', 'maxlen', 'color', 'torus', 'moves', 'invincible', 'direction',
+                  'appended', 'removed', 'dead', 'brightness', 'moved')
+_POWERUP_FIELDS = ('consumed', 'activated', 'ticks')
+_PORTAL_POWERUP_FIELDS = ('orange_activated', 'blue_activated', 'orange_deployed', 'blue_deployed')
+
+
+def _copy_state(players, powerups, entities):
+    """
+    Copy the game objects into plain lists and dicts. This is all the tick has to do for a
+    snapshot; the copy shares nothing mutable with the game, so it can be pickled elsewhere.
+    Links between objects are saved as indexes into the powerup and entity lists.
+    :return: (players, powerups, entities) as plain data
+    """
+    powerup_index = {id(powerup): n for n, powerup in enumerate(powerups)}
+    entity_index = {id(entity): n for n, entity in enumerate(entities)}
+
+    def link(index, obj):
+        return None if obj is None else index[id(obj)]
+
+    saved_players = []
+    for player in players.values():
+        saved = {field: getattr(player, field) for field in _PLAYER_FIELDS}
+        saved['badge_id'] = player.badge_id
+        saved['light_settings'] = list(player.light_settings)
+        saved['trail'] = list(player.trail)
+        saved['powerup'] = link(powerup_index, player.powerup)
+        saved_players.append(saved)
+
+    saved_powerups = []
+    for powerup in powerups:
+        saved = {field: getattr(powerup, field) for field in _POWERUP_FIELDS}
+        saved.update(kind=powerup.kind, x=powerup.x, y=powerup.y)
+        if powerup.kind == 'Portal':
+            saved.update({field: getattr(powerup, field) for field in _PORTAL_POWERUP_FIELDS})
+            saved['orange_portal'] = link(entity_index, powerup.orange_portal)
+            saved['blue_portal'] = link(entity_index, powerup.blue_portal)
+        saved_powerups.append(saved)
+
+    saved_entities = []
+    for entity in entities:
+        saved = {'kind': entity.kind, 'x': entity.x, 'y': entity.y}
+        if entity.kind == 'Portal':
+            saved.update(direction=entity.direction, color=entity.color,
+                         other=link(entity_index, entity.other))
+        saved_entities.append(saved)
+
+    return saved_players, saved_powerups, saved_entities
+
+
+def _restore_state(saved_players, saved_powerups, saved_entities):
+    """
+    Rebuild the game objects from the output of _copy_state.
+    :return: (players, powerups, entities) as the game keeps them
+    """
+    entities = []
+    for saved in saved_entities:
+        if saved['kind'] == 'Portal':
+            entities.append(Portal(saved['x'], saved['y'], saved['direction'], saved['color']))
+        else:
+            entities.append(Entity(saved['x'], saved['y'], saved['kind']))
+    for entity, saved in zip(entities, saved_entities):
+        if saved.get('other') is not None:
+            entity.link(entities[saved['other']])
+
+    powerups = []
+    for saved in saved_powerups:
+        powerup = POWERUPS[POWERUP_KINDS.index(saved['kind'])](saved['x'], saved['y'])
+        for field in _POWERUP_FIELDS:
+            setattr(powerup, field, saved[field])
+        if saved['kind'] == 'Portal':
+            for field in _PORTAL_POWERUP_FIELDS:
+                setattr(powerup, field, saved[field])
+            for field in ('orange_portal', 'blue_portal'):
+                if saved[field] is not None:
+                    setattr(powerup, field, entities[saved[field]])
+        powerups.append(powerup)
+
+    players = {}
+    for saved in saved_players:
+        player = PlayerInfo(saved['badge_id'])
+        for field in _PLAYER_FIELDS:
+            setattr(player, field, saved[field])
+        player.light_settings = list(saved['light_settings'])
+        if player.brightness is None:
+            # The round loop uses None for "lights already turned off", but a restarted game
+            # has to turn them off again when the badge rejoins, and set_lights needs a number
+            player.brightness = 0
+        player.trail = deque(saved['trail'])
+        player.powerup = None if saved['powerup'] is None else powerups[saved['powerup']]
+        players[player.badge_id] = player
+
+    return players, powerups, entities
+
+
+def _write_snapshot(path, state):
+    """
+    Pickle a snapshot and write it so that the file is always either the old one or the complete
+    new one.
+    :param path:  Where to save the snapshot
+    :param state: The snapshot, as plain data
+    :return: None
+    """
+    data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
 class GameComponent(ApplicationSession):
     players = {}
+    snapshot_path = SNAPSHOT_PATH
 
     def onConnect(self):
         """
@@ -527,6 +690,11 @@ class GameComponent(ApplicationSession):
             players = res.kwresults.get("players", [])
             await asyncio.gather(*(self.on_player_join(player) for player in players))
 
+        # Anyone restored from a snapshot who didn't come back with the server's list has left
+        for badge_id in [b for b, p in self.players.items() if not p.subscriptions]:
+            print("Badge #{} did not rejoin".format(badge_id))
+            del self.players[badge_id]
+
     async def on_button_release(self, button, timestamp=0, badge_id=None):
         """
         Called when a button is released.
@@ -596,12 +764,19 @@ class GameComponent(ApplicationSession):
         # the list of subscriptions below
         #release_sub = await self.subscribe(self.on_button_release, 'badge.' + str(badge_id) + '.button.release')
 
-        # Add an entry to keep track of the player's game-state
-        self.players[badge_id] = PlayerInfo(badge_id, torus=(TORUS_H, TORUS_V), subscriptions=[press_sub])
+        player = self.players.get(badge_id, None)
+        if player and not player.subscriptions:
+            # Restored from a snapshot; carry on with the saved state
+            player.subscriptions.append(press_sub)
+        else:
+            # Add an entry to keep track of the player's game-state
+            self.players[badge_id] = PlayerInfo(badge_id, torus=(TORUS_H, TORUS_V), subscriptions=[press_sub])
 
         self.publish('badge.' + str(badge_id) + '.clear_text')
         await self.set_lights(self.players[badge_id])
 
+        self.player_joined.set()
+
     async def on_player_leave(self, badge_id):
         """
         Called when a player leaves the game, such as by leaving a designated location.
@@ -614,6 +789,177 @@ class GameComponent(ApplicationSession):
         await asyncio.gather(*(s.unsubscribe() for s in self.players[badge_id].subscriptions))
         del self.players[badge_id]
 
+    def send_frame(self, display=None):
+        """
+        Send the frame that has been drawn to the sign, and what changed since the last one to
+        spectators. Any overlays are drawn over it in sign pixels, then dropped.
+        :param display: Where the frame was drawn, if not on the board
+        :return: None
+        """
+        display = display or self.screen
+        if display is not self.sign:
+            # The board is scaled onto the sign; put it there first so overlays end up on top
+            display.compose()
+        for sprite, x, y in self.overlays:
+            self.sign.blit(sprite, x, y)
+        self.overlays = []
+        self.sign.send()
+        self.save_snapshot()
+
+        frame = self.spectator.update(self.players, self.powerups, self.entities)
+        if frame:
+            self.publish('game.' + GAME_ID + '.spectate', frame)
+
+    def on_spectator_join(self):
+        """
+        Called by a spectator that just subscribed, so it doesn't have to wait for the next
+        scheduled keyframe. Requests are rate-limited by SPECTATOR_MIN_KEYFRAME_GAP.
+        :return: None
+        """
+        self.spectator.request_keyframe()
+
+    def save_snapshot(self):
+        """
+        Save the game state if a snapshot is due. The state is copied right away so it is
+        consistent, but pickled and written to disk on a worker thread to keep the tick short.
+        :return: None
+        """
+        if not self.snapshot_path or time.time() < self.next_snapshot:
+            return
+        if self.snapshot_write and not self.snapshot_write.done():
+            # The disk is slower than the snapshot interval; skip this one rather than queue up
+            return
+
+        now = time.time()
+        self.next_snapshot = now + SNAPSHOT_INTERVAL
+        players, powerups, entities = _copy_state(self.players, self.powerups, self.entities)
+        state = {
+            'version': SNAPSHOT_VERSION,
+            'game_id': GAME_ID,
+            'time': now,
+            'phase': self.phase,
+            'next_powerup': self.next_powerup - now,
+            'powerup_count': self.powerup_count,
+            'players': players,
+            'powerups': powerups,
+            'entities': entities,
+        }
+
+        self.snapshot_write = asyncio.get_event_loop().run_in_executor(
+            None, _write_snapshot, self.snapshot_path, state)
+        self.snapshot_write.add_done_callback(self._snapshot_written)
+
+    def _snapshot_written(self, future):
+        if future.exception():
+            print("Could not save snapshot:", future.exception())
+
+    def load_snapshot(self):
+        """
+        Restore the game state from the last snapshot, if there is a recent one. Restored players
+        have no subscriptions until they rejoin through game_register.
+        :return: True if a round was in progress and should be resumed
+        """
+        if not self.snapshot_path:
+            return False
+
+        # Anything wrong with the file, down to a missing field, just means a normal start
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                state = pickle.load(f)
+
+            if state['version'] != SNAPSHOT_VERSION:
+                print("Ignoring snapshot from version", state['version'])
+                return False
+
+            age = time.time() - state['time']
+            if state['game_id'] != GAME_ID or not 0 <= age <= SNAPSHOT_MAX_AGE:
+                return False
+
+            players, powerups, entities = _restore_state(
+                state['players'], state['powerups'], state['entities'])
+            next_powerup = time.time() + float(state['next_powerup'])
+            powerup_count = int(state['powerup_count'])
+            resume = state['phase'] != 'waiting'
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print("Could not load snapshot:", repr(e))
+            return False
+
+        self.players.clear()
+        self.players.update(players)
+        self.powerups = powerups
+        self.entities = entities
+        self.next_powerup = next_powerup
+        self.powerup_count = powerup_count
+
+        print("Restored {} players from a snapshot {:.1f}s old".format(len(self.players), age))
+        return resume
+
+    async def play_attract(self):
+        """
+        Play the attract animations until there are enough players for a round. Returns as soon
+        as the second player joins, or when there is nothing to play.
+        :return: None
+        """
+        frames = attract.Prefetcher(
+            attract.frames(ATTRACT_DIR, self.sign.width, self.sign.height, ATTRACT_FPS, ATTRACT_HOLD,
+                           self.sign.transparent),
+            ATTRACT_PREFETCH)
+
+        try:
+            while len(self.players) < 2:
+                frame = frames.get()
+                if frame:
+                    pixels, duration = frame
+                    self.sign.set_frame(pixels)
+                elif frames.done:
+                    # Nothing (left) to play; onJoin shows the joined players instead
+                    return
+                else:
+                    # Decoding fell behind; keep what's on the sign
+                    duration = 1 / ATTRACT_FPS
+
+                # Board cells are only sign pixels when the board isn't scaled onto the sign
+                if self.screen is self.sign:
+                    for player in self.players.values():
+                        player.draw(self.sign)
+                self.send_frame(self.sign)
+
+                self.player_joined.clear()
+                try:
+                    await asyncio.wait_for(self.player_joined.wait(), duration)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            frames.stop()
+            self.sign.clear()
+
+    def draw_winner(self, player):
+        """
+        Put the winner's name and record on the sign, over the board, for the next frame. The
+        text is drawn in sign pixels however the board is scaled.
+        :param player: The winning player
+        :return: None
+        """
+        color = hex_to_rgb(player.color)
+        # Wins and plays are only updated once the round is over
+        banner = font.text("#{} wins!".format(player.badge_id), color, scale=3)
+        record = font.text("Wins: {}  Plays: {}".format(player.wins + 1, player.plays + 1), color)
+
+        width = self.sign.width
+        self.overlays.append((banner, (width - banner.width) // 2, 0))
+        self.overlays.append((record, (width - record.width) // 2, banner.height + 2))
+
+    def make_screen(self):
+        """
+        Create the sign the game is shown on. Override this to draw somewhere else, e.g. for
+        load testing without a sign.
+        :return: A flaschen.FanOut, or another flaschen.Canvas with a send() method
+        """
+        targets = [flaschen.Target(*display) for display in DISPLAYS]
+        return flaschen.FanOut(targets, SIGN_WIDTH, SIGN_HEIGHT, transparent=True)
+
     async def onJoin(self, details):
         """
         WAMP calls this after successfully joining the realm.
@@ -621,45 +967,73 @@ class GameComponent(ApplicationSession):
         :return: None
         """
 
-        self.screen = flaschen.Flaschen('scootaloo.hackafe.net', 1337, WIDTH, HEIGHT, 16, True)
+        self.sign = self.make_screen()
+        if (WIDTH, HEIGHT) == (self.sign.width, self.sign.height) and VIEWPORT_SCALE in (None, 1):
+            self.screen = self.sign
+        else:
+            self.screen = flaschen.Viewport(self.sign, WIDTH, HEIGHT, VIEWPORT_SCALE)
+        self.spectator = spectator.SpectatorStream(WIDTH, HEIGHT, POWERUP_KINDS, SPECTATOR_KEYFRAME_INTERVAL,
+                                                  SPECTATOR_MIN_KEYFRAME_GAP)
         self.powerups = []
         self.entities = []
+        # (sprite, x, y) to draw on the sign over the next frame
+        self.overlays = []
+        # 'waiting' for players, moving them in a 'round', or the 'flash' of the winner after it
+        self.phase = 'waiting'
+        self.next_powerup = 0
+        self.powerup_count = 0
+        self.next_snapshot = 0
+        self.snapshot_write = None
+        self.player_joined = asyncio.Event()
+
+        resume = self.load_snapshot()
 
         # Subscribe to all necessary things
         await self.subscribe(self.on_player_join, 'game.' + GAME_ID + '.player.join')
         await self.subscribe(self.on_player_leave, 'game.' + GAME_ID + '.player.leave')
         await self.subscribe(self.game_register, 'game.request_register')
+        await self.register(self.on_spectator_join, 'game.' + GAME_ID + '.spectate.join')
         await self.game_register()
 
         while True:
-            # Wait until there are two players
-            while len(self.players) < 2:
+            if not resume:
+                # Wait until there are two players
+                if ATTRACT_DIR and len(self.players) < 2:
+                    await self.play_attract()
+
+                while len(self.players) < 2:
+                    for player in self.players.values():
+                        player.draw(self.screen)
+                    self.send_frame()
+                    await asyncio.sleep(.5)
+
+                # Draw out everyone's dots for a couple seconds
                 for player in self.players.values():
+                    player.brightness = .1
+                    await self.set_lights(player)
                     player.draw(self.screen)
-                self.screen.send()
-                await asyncio.sleep(.5)
+                self.send_frame()
 
-            # Draw out everyone's dots for a couple seconds
-            for player in self.players.values():
-                player.brightness = .1
-                await self.set_lights(player)
-                player.draw(self.screen)
-            self.screen.send()
+                await asyncio.sleep(2)
+                self.screen.clear()
 
-            await asyncio.sleep(2)
-            self.screen.clear()
+                self.next_powerup = 0
+                self.powerup_count = len(self.players) + 5
+
+            resume = False
+            self.phase = 'round'
+            # When the current tick's work started, for measuring it against the tick budget
+            self.tick_start = time.perf_counter()
 
-            next_powerup = 0
-            powerup_count = len(self.players) + 5
             # Move players until only one (or none) are left
             while sum((not p.dead for p in self.players.values())) > 1:
                 # approx every 10 seconds
-                if time.time() >= next_powerup:
-                    next_powerup = time.time() + 5
-                    for _ in range(powerup_count):
+                if time.time() >= self.next_powerup:
+                    self.next_powerup = time.time() + 5
+                    for _ in range(self.powerup_count):
                         x, y = random.randrange(WIDTH), random.randrange(HEIGHT)
                         self.powerups.append(random.choice(POWERUPS)(x, y))
-                    powerup_count = 1
+                    self.powerup_count = 1
 
                 for player in self.players.values():
                     player.draw(self.screen)
@@ -676,12 +1050,14 @@ class GameComponent(ApplicationSession):
                 for entity in self.entities:
                     entity.draw(self.screen)
 
-                self.screen.send()
+                self.send_frame()
                 self.screen.clear()
 
                 await asyncio.sleep(1 / TICK_RATE)
+                self.tick_start = time.perf_counter()
 
             # Flash the winner's strings
+            self.phase = 'flash'
             while any((not player.nommed() for player in self.players.values() if player.dead)):
                 for on in (True, True, True, False, False, False, False):
                     self.screen.clear()
@@ -693,6 +1069,7 @@ class GameComponent(ApplicationSession):
                                 self.publish('badge.' + str(player.badge_id) + '.text', 0, 24, "You win!!!", style=1)
                                 await self.set_lights(player)
                                 player.draw(self.screen)
+                                self.draw_winner(player)
                             else:
                                 self.publish('badge.' + str(player.badge_id) + '.text', 0, 24, "          ", style=1)
                                 await self.set_lights(player)
@@ -701,7 +1078,7 @@ class GameComponent(ApplicationSession):
                             player.nom()
                             player.draw(self.screen)
 
-                    self.screen.send()
+                    self.send_frame()
                     await asyncio.sleep(1 / TICK_RATE)
 
             # Update the players' text
@@ -716,13 +1093,14 @@ class GameComponent(ApplicationSession):
 
 
             self.screen.clear()
-            self.screen.send()
+            self.send_frame()
 
             for player in self.players.values():
                 player.reset()
 
             self.powerups = []
             self.entities = []
+            self.phase = 'waiting'
             
 
     def onDisconnect(self):
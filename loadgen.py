@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+"""
+Synthetic load generator for the sign game.
+
+Runs the real GameComponent without a WAMP router or a sign: WAMP calls are answered locally,
+frames are encoded but never leave the process, and a crowd of bot badges join through
+game.<GAME_ID>.player.join and press buttons like people would. Tick-rate stability, publish
+volume and CPU/memory usage are sampled while it runs so the breaking point can be found before
+the event instead of during it.
+
+Example:
+    python3 loadgen.py --players 300 --ramp-step 25 --ramp-interval 10 --csv load.csv
+"""
+
+from types import SimpleNamespace
+import argparse
+import asyncio
+import csv
+import json
+import os
+import random
+import resource
+import statistics
+import tempfile
+import time
+
+import flaschen
+import game
+
+
+# Badge ids handed out to bots start here so they're easy to tell apart from real ones
+BOT_BADGE_BASE = 10000
+
+
+class NullFlaschen(flaschen.Flaschen):
+    """
+    A Flaschen that encodes every frame as usual but only records when it would have sent it,
+    and what phase the game was in at the time.
+    """
+
+    def __init__(self, session, width, height, layer=0, transparent=False):
+        # Connecting a UDP socket doesn't send anything, it just gives the parent a valid socket
+        super().__init__('127.0.0.1', 9, width, height, layer, transparent)
+        self._sock.close()
+        self.session = session
+        self.frames = []
+        self.frame_bytes = 0
+
+    def send(self):
+        self.frames.append((time.perf_counter(), self.session.phase))
+        self.frame_bytes += len(self._data)
+
+
+class _Subscription:
+    def __init__(self, session, topic, handler):
+        self.session = session
+        self.topic = topic
+        self.handler = handler
+
+    async def unsubscribe(self):
+        handlers = self.session.handlers.get(self.topic, [])
+        if self.handler in handlers:
+            handlers.remove(self.handler)
+
+
+class LoadTestComponent(game.GameComponent):
+    """
+    A GameComponent that answers its own WAMP traffic: subscriptions are kept in a local table
+    so bots can fire them, and publishes are only counted. Snapshots are off unless
+    snapshot_path is set, so a load test can't overwrite the real game's.
+    """
+
+    snapshot_path = None
+
+    def __init__(self, config=None):
+        super().__init__(config)
+        self.handlers = {}
+        self.procedures = {}
+        self.publishes = {}
+        self.publish_bytes = 0
+        # Seconds of work in each round tick, from waking up to the frame being sent
+        self.tick_work = []
+
+    def make_screen(self):
+        return NullFlaschen(self, game.SIGN_WIDTH, game.SIGN_HEIGHT, 16, True)
+
+    def send_frame(self, display=None):
+        super().send_frame(display)
+        if self.phase == 'round':
+            self.tick_work.append(time.perf_counter() - self.tick_start)
+
+    def publish(self, topic, *args, **kwargs):
+        kind = topic.rsplit('.', 1)[-1]
+        self.publishes[kind] = self.publishes.get(kind, 0) + 1
+        self.publish_bytes += _payload_size(topic, args, kwargs)
+
+    async def subscribe(self, handler, topic=None, options=None):
+        self.handlers.setdefault(topic, []).append(handler)
+        return _Subscription(self, topic, handler)
+
+    async def register(self, endpoint, procedure=None, options=None):
+        self.procedures[procedure] = endpoint
+
+    async def call(self, procedure, *args, **kwargs):
+        return SimpleNamespace(results=[], kwresults={'players': []})
+
+    async def fire(self, topic, *args, **kwargs):
+        """
+        Deliver an event to everything subscribed to a topic, like the router would.
+        :param topic: The topic to deliver to
+        :return: None
+        """
+        for handler in list(self.handlers.get(topic, [])):
+            await handler(*args, **kwargs)
+
+    def onDisconnect(self):
+        pass
+
+
+def _payload_size(topic, args, kwargs):
+    """Approximate on-the-wire size of a publish, as the JSON serializer would see it."""
+    size = len(topic)
+    for arg in args:
+        if isinstance(arg, (bytes, bytearray)):
+            size += len(arg)
+        else:
+            size += len(json.dumps(arg))
+    for key, value in kwargs.items():
+        size += len(key) + len(json.dumps(value))
+    return size
+
+
+class Bot:
+    """A simulated badge that steers away from walls and trails and uses its powerups."""
+
+    TURNS = {
+        'u': ('l', 'r'),
+        'd': ('r', 'l'),
+        'l': ('d', 'u'),
+        'r': ('u', 'd'),
+    }
+
+    BUTTONS = {
+        'u': game.Button.UP,
+        'd': game.Button.DOWN,
+        'l': game.Button.LEFT,
+        'r': game.Button.RIGHT,
+    }
+
+    def __init__(self, badge_id, input_rate, lookahead=8):
+        self.badge_id = badge_id
+        self.input_rate = input_rate
+        self.lookahead = lookahead
+        self.next_input = time.perf_counter() + random.random() / input_rate
+        self.portal_pending = False
+
+    def free_run(self, player, direction, occupied):
+        """
+        How many cells the player could travel in a direction before hitting something.
+        :param player:    The bot's PlayerInfo
+        :param direction: The direction to look in
+        :param occupied:  Set of every cell with a trail in it
+        :return: Number of free cells, up to the lookahead
+        """
+        dx, dy = game.dir_to_dxdy(direction)
+        x, y = player.position
+        for n in range(self.lookahead):
+            x, y = x + dx, y + dy
+            if player.torus[0]:
+                x %= game.WIDTH
+            if player.torus[1]:
+                y %= game.HEIGHT
+            if x < 0 or x >= game.WIDTH or y < 0 or y >= game.HEIGHT or (x, y) in occupied:
+                return n
+        return self.lookahead
+
+    def decide(self, player, occupied):
+        """
+        Pick the buttons to press this turn.
+        :param player:   The bot's PlayerInfo
+        :param occupied: Set of every cell with a trail in it
+        :return: A list of button names
+        """
+        presses = []
+
+        straight = player.direction
+        left, right = self.TURNS[straight]
+        runs = {d: self.free_run(player, d, occupied) for d in (straight, left, right)}
+        best = max(runs.values())
+
+        # Go straight unless something better is to the side, with the occasional wander
+        if runs[straight] < best or (runs[straight] == best and random.random() < .05):
+            choices = [d for d in (left, right) if runs[d] == best]
+            if choices:
+                presses.append(self.BUTTONS[random.choice(choices)])
+
+        powerup = player.powerup
+        if powerup and not self.portal_pending and not powerup.activated and random.random() < .3:
+            presses.append(game.Button.B)
+            self.portal_pending = powerup.kind == 'Portal'
+        elif self.portal_pending:
+            if not powerup or powerup.kind != 'Portal':
+                self.portal_pending = False
+            elif powerup.orange_deployed and random.random() < .3:
+                presses.append(game.Button.A)
+                self.portal_pending = False
+
+        return presses
+
+
+class LoadGenerator:
+    """Joins bots into a LoadTestComponent, drives their input and samples the results."""
+
+    def __init__(self, session, players, input_rate, ramp_step, ramp_interval):
+        self.session = session
+        self.target_players = players
+        self.input_rate = input_rate
+        self.ramp_step = ramp_step or players
+        self.ramp_interval = ramp_interval
+        self.bots = {}
+        self.bot_time = 0.0
+        self.samples = []
+
+    async def ramp(self):
+        """Join bots in steps until the target player count is reached."""
+        join_topic = 'game.' + game.GAME_ID + '.player.join'
+        while len(self.bots) < self.target_players:
+            for _ in range(min(self.ramp_step, self.target_players - len(self.bots))):
+                badge_id = BOT_BADGE_BASE + len(self.bots)
+                self.bots[badge_id] = Bot(badge_id, self.input_rate)
+                await self.session.fire(join_topic, badge_id)
+            await asyncio.sleep(self.ramp_interval)
+
+    async def drive(self):
+        """Let every bot whose turn it is look at the board and press buttons."""
+        while True:
+            start = time.perf_counter()
+            due = [bot for bot in self.bots.values() if start >= bot.next_input]
+
+            if due:
+                players = self.session.players
+                occupied = set()
+                for player in players.values():
+                    occupied.update(player.trail)
+
+                events = []
+                for bot in due:
+                    bot.next_input = start + random.uniform(.5, 1.5) / bot.input_rate
+                    player = players.get(bot.badge_id)
+                    if player is None or player.dead:
+                        continue
+                    for button in bot.decide(player, occupied):
+                        events.append((bot.badge_id, button))
+
+                self.bot_time += time.perf_counter() - start
+
+                for badge_id, button in events:
+                    await self.session.fire('badge.' + str(badge_id) + '.button.press',
+                                            button, timestamp=int(time.time()), badge_id=badge_id)
+
+            await asyncio.sleep(1 / (2 * game.TICK_RATE))
+
+    async def sample(self, interval):
+        """Record a row of statistics every interval seconds."""
+        screen = self.session.sign
+        start = last = time.perf_counter()
+        last_cpu = time.process_time()
+        last_bot = self.bot_time
+        last_publishes = 0
+        last_publish_bytes = 0
+        last_frame_bytes = 0
+        last_frame = (None, None)
+
+        while True:
+            await asyncio.sleep(interval)
+
+            now = time.perf_counter()
+            cpu = time.process_time()
+            elapsed = now - last
+
+            frames, screen.frames = screen.frames, []
+            # Only back-to-back frames from the round loop are ticks; waiting for players and
+            # flashing the winner have their own pace
+            ticks = [b - a for (a, a_phase), (b, b_phase) in zip([last_frame] + frames, frames)
+                     if a_phase == b_phase == 'round']
+            if frames:
+                last_frame = frames[-1]
+            work, self.session.tick_work = self.session.tick_work, []
+
+            publishes = sum(self.session.publishes.values())
+            players = self.session.players
+
+            row = {
+                'time': round(now - start, 2),
+                'phase': self.session.phase,
+                'players': len(players),
+                'alive': sum(not p.dead for p in players.values()),
+                'trail_cells': sum(len(p.trail) for p in players.values()),
+                'fps': round(len(frames) / elapsed, 2),
+                'tick_ms_mean': round(1000 * statistics.mean(ticks), 2) if ticks else '',
+                'tick_ms_p95': round(1000 * _percentile(ticks, .95), 2) if ticks else '',
+                'tick_ms_max': round(1000 * max(ticks), 2) if ticks else '',
+                'ticks': len(ticks),
+                'tick_rate': round(1 / statistics.mean(ticks), 1) if ticks else '',
+                'work_ms_mean': round(1000 * statistics.mean(work), 2) if work else '',
+                'work_ms_p95': round(1000 * _percentile(work, .95), 2) if work else '',
+                'frame_kbps': round((screen.frame_bytes - last_frame_bytes) / elapsed / 1000, 1),
+                'publishes_per_s': round((publishes - last_publishes) / elapsed, 1),
+                'publish_kbps': round((self.session.publish_bytes - last_publish_bytes) / elapsed / 1000, 1),
+                'cpu_pct': round(100 * (cpu - last_cpu) / elapsed, 1),
+                'bot_cpu_pct': round(100 * (self.bot_time - last_bot) / elapsed, 1),
+                'rss_mb': round(_rss_bytes() / 2 ** 20, 1),
+            }
+            self.samples.append(row)
+            print(' '.join('{}={}'.format(k, v) for k, v in row.items()), flush=True)
+
+            last, last_cpu, last_bot = now, cpu, self.bot_time
+            last_publishes = publishes
+            last_publish_bytes = self.session.publish_bytes
+            last_frame_bytes = screen.frame_bytes
+
+    def breaking_point(self):
+        """
+        Find the first sample where the work in a round tick used up the whole tick budget of
+        1 / TICK_RATE. Ticks are always slower than that, since the round loop sleeps a full tick
+        after its work, so comparing tick times against the budget would say nothing. Samples
+        with no round ticks in them, like those before the first round starts, don't count.
+        :return: The sample row, or None if the work always fit
+        """
+        for row in self.samples:
+            if row['work_ms_mean'] != '' and row['work_ms_mean'] >= 1000 / game.TICK_RATE:
+                return row
+        return None
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _rss_bytes():
+    """Current resident set size, falling back to the peak where /proc isn't available."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        session = LoadTestComponent()
+        if args.snapshots:
+            # Snapshots are part of the tick's work in a real game, so they're measured too
+            session.snapshot_path = os.path.join(snapshot_dir, 'game-state.pickle')
+        await _run(session, args)
+
+
+async def _run(session, args):
+    generator = LoadGenerator(session, args.players, args.input_rate, args.ramp_step, args.ramp_interval)
+
+    game_task = asyncio.ensure_future(session.onJoin(None))
+    # onJoin creates the sign and subscribes before it first yields to us
+    await asyncio.sleep(0)
+
+    tasks = [
+        game_task,
+        asyncio.ensure_future(generator.ramp()),
+        asyncio.ensure_future(generator.drive()),
+        asyncio.ensure_future(generator.sample(args.sample_interval)),
+    ]
+
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=args.duration, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception():
+                raise task.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if args.csv and generator.samples:
+        with open(args.csv, 'w', newline='') as out:
+            writer = csv.DictWriter(out, fieldnames=list(generator.samples[0]))
+            writer.writeheader()
+            writer.writerows(generator.samples)
+
+    budget = 1000 / game.TICK_RATE
+    broke = generator.breaking_point()
+    if broke:
+        print("Tick work used up the {:.1f} ms budget at {} players ({} alive, {} trail cells): "
+              "{} ms per tick, {} ticks/s achieved".format(
+                  budget, broke['players'], broke['alive'], broke['trail_cells'],
+                  broke['work_ms_mean'], broke['tick_rate']))
+    else:
+        worked = [row for row in generator.samples if row['work_ms_mean'] != '']
+        if worked:
+            busiest = max(worked, key=lambda row: row['work_ms_mean'])
+            print("Tick work fit the {:.1f} ms budget for the whole run; at most {} ms per tick "
+                  "at {} players, {} ticks/s achieved".format(
+                      budget, busiest['work_ms_mean'], busiest['players'], busiest['tick_rate']))
+        else:
+            print("No round was played")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--players', type=int, default=100, help="number of bot badges to join")
+    parser.add_argument('--input-rate', type=float, default=4.0,
+                        help="average decisions (button presses) per bot per second")
+    parser.add_argument('--ramp-step', type=int, default=0,
+                        help="bots joined at a time; 0 joins them all at once")
+    parser.add_argument('--ramp-interval', type=float, default=10.0,
+                        help="seconds between ramp steps")
+    parser.add_argument('--duration', type=float, default=60.0, help="seconds to run for")
+    parser.add_argument('--sample-interval', type=float, default=1.0,
+                        help="seconds between statistics samples")
+    parser.add_argument('--csv', help="write the samples to this CSV file")
+    parser.add_argument('--board', help="board size in cells as WIDTHxHEIGHT, scaled onto the sign")
+    parser.add_argument('--seed', type=int, help="random seed, for repeatable runs")
+    parser.add_argument('--no-snapshots', dest='snapshots', action='store_false',
+                        help="don't save game snapshots, to see how much they cost")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    if args.board:
+        game.WIDTH, game.HEIGHT = (int(n) for n in args.board.lower().split('x'))
+
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
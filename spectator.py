@@ -0,0 +1,365 @@
+"""
+Compact binary game-state stream for spectators.
+
+Every tick the game hands its state to a SpectatorStream, which works out what changed since the
+previous tick and encodes only that: cells added to the head of a trail, how many cells were
+eaten off the tail, powerups spawned or taken and portals placed. Every so often a keyframe with
+the complete board is sent instead so that late joiners can catch up without asking.
+
+A frame starts with a header:
+
+    u8 frame type (KEYFRAME or DELTA), u32 sequence number
+    u16 width, u16 height                                     (keyframes only)
+
+followed by records until the end of the frame, each an opcode and its fields. All integers are
+little-endian, cells are (u16 x, u16 y) and colors are r, g, b bytes.
+
+    PLAYER          u16 id, rgb color, u8 dead, u8 name length, name, u16 cell count, cells
+    HEAD            u16 id, u8 cell count, cells
+    TAIL            u16 id, u16 cells removed from the tail
+    DEAD            u16 id
+    LEAVE           u16 id
+    POWERUP         u16 id, cell, u8 kind, rgb color
+    POWERUP_REMOVE  u16 id
+    PORTAL          u16 id, cell, u8 direction (0-3 = u, r, d, l), rgb color
+    PORTAL_REMOVE   u16 id
+
+A PLAYER record replaces everything known about that player. A keyframe replaces everything.
+Deltas are applied in order, and only on top of the frame with the previous sequence number.
+"""
+
+from collections import deque
+import struct
+
+KEYFRAME = 1
+DELTA = 2
+
+OP_PLAYER = 1
+OP_HEAD = 2
+OP_TAIL = 3
+OP_DEAD = 4
+OP_LEAVE = 5
+OP_POWERUP = 6
+OP_POWERUP_REMOVE = 7
+OP_PORTAL = 8
+OP_PORTAL_REMOVE = 9
+
+DIRECTIONS = 'urdl'
+
+_HEADER = struct.Struct('<BI')
+_SIZE = struct.Struct('<HH')
+_CELL = struct.Struct('<HH')
+_PLAYER = struct.Struct('<BHBBBBB')
+_HEAD = struct.Struct('<BHB')
+_TAIL = struct.Struct('<BHH')
+_ID = struct.Struct('<BH')
+_POWERUP = struct.Struct('<BHHHBBBB')
+_PORTAL = struct.Struct('<BHHHBBBB')
+_COUNT = struct.Struct('<H')
+
+
+def _rgb(color):
+    return (color >> 16) & 0xff, (color >> 8) & 0xff, color & 0xff
+
+
+def _cells(cells):
+    return b''.join(_CELL.pack(x, y) for x, y in cells)
+
+
+class _Seen:
+    """What the stream last told spectators about one player."""
+
+    def __init__(self, pid, player):
+        self.pid = pid
+        self.update(player)
+
+    def update(self, player):
+        self.trail = player.trail
+        self.appended = player.appended
+        self.removed = player.removed
+        self.dead = player.dead
+
+
+class SpectatorStream:
+    """Encodes the game state into keyframes and delta frames, one call per tick."""
+
+    def __init__(self, width, height, kinds, keyframe_interval=48, min_keyframe_gap=12):
+        """
+        :param width:             Width of the board in cells
+        :param height:            Height of the board in cells
+        :param kinds:             List of powerup kind names; a powerup's kind is sent as its index
+        :param keyframe_interval: Send a keyframe at least every this many frames
+        :param min_keyframe_gap:  Requested keyframes are sent at most every this many frames
+        """
+        self.width = width
+        self.height = height
+        self.kinds = {kind: n for n, kind in enumerate(kinds)}
+        self.keyframe_interval = keyframe_interval
+        self.min_keyframe_gap = min_keyframe_gap
+        self.keyframe_requested = False
+
+        self.seq = 0
+        self.since_keyframe = None
+
+        self._next_id = 0
+        self._players = {}
+        self._powerups = {}
+        self._portals = {}
+
+    def request_keyframe(self):
+        """
+        Ask for a keyframe soon, e.g. because a spectator just joined. Keyframes are expensive, so
+        however often this is called, it won't cause one more than every min_keyframe_gap frames.
+        """
+        self.keyframe_requested = True
+
+    def update(self, players, powerups, entities):
+        """
+        Compare the game state with what was last sent and encode the difference.
+        :param players:  Dict of badge id to PlayerInfo
+        :param powerups: List of Powerups on the board
+        :param entities: List of Entities on the board
+        :return: The encoded frame, or None if nothing changed and no keyframe is due
+        """
+        records = []
+        self._diff_players(players, records)
+        self._diff_powerups(powerups, records)
+        self._diff_portals(entities, records)
+
+        # Counted in ticks, not frames sent, so a quiet board still gets its keyframes
+        if self.since_keyframe is None:
+            due = True
+        else:
+            self.since_keyframe += 1
+            if self.keyframe_requested:
+                due = self.since_keyframe >= self.min_keyframe_gap
+            else:
+                due = self.since_keyframe >= self.keyframe_interval
+        if due:
+            return self._keyframe(players, powerups, entities)
+
+        if not records:
+            return None
+
+        self.seq = (self.seq + 1) & 0xffffffff
+        return _HEADER.pack(DELTA, self.seq) + b''.join(records)
+
+    def _keyframe(self, players, powerups, entities):
+        self.seq = (self.seq + 1) & 0xffffffff
+        self.since_keyframe = 0
+        self.keyframe_requested = False
+
+        records = [_HEADER.pack(KEYFRAME, self.seq), _SIZE.pack(self.width, self.height)]
+        for badge_id, player in players.items():
+            records.append(self._player_record(self._players[badge_id].pid, badge_id, player))
+        for powerup in powerups:
+            if not powerup.consumed:
+                records.append(self._powerup_record(self._powerups[id(powerup)][0], powerup))
+        for entity in entities:
+            if id(entity) in self._portals:
+                records.append(self._portal_record(self._portals[id(entity)][0], entity))
+        return b''.join(records)
+
+    def _new_id(self):
+        self._next_id = (self._next_id + 1) & 0xffff
+        return self._next_id
+
+    def _player_record(self, pid, badge_id, player):
+        name = str(badge_id).encode('utf-8')[:255]
+        trail = player.trail
+        if len(trail) > 0xffff:
+            trail = list(trail)[-0xffff:]
+        return b''.join([_PLAYER.pack(OP_PLAYER, pid, *_rgb(player.color), player.dead, len(name)),
+                         name, _COUNT.pack(len(trail)), _cells(trail)])
+
+    def _powerup_record(self, uid, powerup):
+        return _POWERUP.pack(OP_POWERUP, uid, powerup.x, powerup.y,
+                             self.kinds.get(powerup.kind, 0xff), *_rgb(powerup.color))
+
+    def _portal_record(self, uid, portal):
+        return _PORTAL.pack(OP_PORTAL, uid, portal.x, portal.y,
+                            DIRECTIONS.index(portal.direction), *_rgb(portal.color))
+
+    def _diff_players(self, players, records):
+        for badge_id in [b for b in self._players if b not in players]:
+            records.append(_ID.pack(OP_LEAVE, self._players.pop(badge_id).pid))
+
+        for badge_id, player in players.items():
+            seen = self._players.get(badge_id)
+
+            if seen is None:
+                seen = self._players[badge_id] = _Seen(self._new_id(), player)
+                records.append(self._player_record(seen.pid, badge_id, player))
+                continue
+
+            added = player.appended - seen.appended
+            removed = player.removed - seen.removed
+
+            # A new round gives the player a new trail, and cells that were added and eaten
+            # again since the last frame can't be expressed as a delta; resend the player
+            if player.trail is not seen.trail or added > len(player.trail):
+                records.append(self._player_record(seen.pid, badge_id, player))
+                seen.update(player)
+                continue
+
+            if added:
+                trail = player.trail
+                start = len(trail) - added
+                while start < len(trail):
+                    count = min(0xff, len(trail) - start)
+                    cells = (trail[n] for n in range(start, start + count))
+                    records.append(_HEAD.pack(OP_HEAD, seen.pid, count) + _cells(cells))
+                    start += count
+
+            while removed:
+                count = min(0xffff, removed)
+                records.append(_TAIL.pack(OP_TAIL, seen.pid, count))
+                removed -= count
+
+            if player.dead and not seen.dead:
+                records.append(_ID.pack(OP_DEAD, seen.pid))
+
+            seen.update(player)
+
+    def _diff_powerups(self, powerups, records):
+        current = {id(p) for p in powerups}
+        for key in [k for k in self._powerups if k not in current]:
+            uid, consumed, _ = self._powerups.pop(key)
+            if not consumed:
+                records.append(_ID.pack(OP_POWERUP_REMOVE, uid))
+
+        for powerup in powerups:
+            known = self._powerups.get(id(powerup))
+            if known is None:
+                # Keep a reference along with the id so id() can't be reused while it's tracked
+                uid = self._new_id()
+                self._powerups[id(powerup)] = [uid, powerup.consumed, powerup]
+                if not powerup.consumed:
+                    records.append(self._powerup_record(uid, powerup))
+            elif powerup.consumed and not known[1]:
+                known[1] = True
+                records.append(_ID.pack(OP_POWERUP_REMOVE, known[0]))
+
+    def _diff_portals(self, entities, records):
+        current = {id(e) for e in entities}
+        for key in [k for k in self._portals if k not in current]:
+            records.append(_ID.pack(OP_PORTAL_REMOVE, self._portals.pop(key)[0]))
+
+        for entity in entities:
+            if entity.kind == 'Portal' and id(entity) not in self._portals:
+                uid = self._new_id()
+                self._portals[id(entity)] = (uid, entity)
+                records.append(self._portal_record(uid, entity))
+
+
+class SpectatorView:
+    """Rebuilds the board from a spectator stream, e.g. to show it on a second screen."""
+
+    def __init__(self):
+        self.seq = None
+        self.width = 0
+        self.height = 0
+        self.players = {}
+        self.powerups = {}
+        self.portals = {}
+
+    @property
+    def synced(self):
+        return self.seq is not None
+
+    def apply(self, frame):
+        """
+        Apply one frame from the stream.
+        :param frame: The encoded frame
+        :return: True if the frame was applied, False if it was skipped waiting for a keyframe
+        """
+        kind, seq = _HEADER.unpack_from(frame, 0)
+        offset = _HEADER.size
+
+        if kind == KEYFRAME:
+            self.width, self.height = _SIZE.unpack_from(frame, offset)
+            offset += _SIZE.size
+            self.players = {}
+            self.powerups = {}
+            self.portals = {}
+        elif self.seq is None or seq != (self.seq + 1) & 0xffffffff:
+            # Missed a frame; nothing is trustworthy until the next keyframe
+            self.seq = None
+            return False
+
+        self.seq = seq
+
+        while offset < len(frame):
+            op = frame[offset]
+
+            if op == OP_PLAYER:
+                _, pid, r, g, b, dead, name_len = _PLAYER.unpack_from(frame, offset)
+                offset += _PLAYER.size
+                name = frame[offset:offset + name_len].decode('utf-8')
+                offset += name_len
+                count, = _COUNT.unpack_from(frame, offset)
+                offset += _COUNT.size
+                self.players[pid] = {
+                    'name': name,
+                    'color': (r, g, b),
+                    'dead': bool(dead),
+                    'trail': deque(_CELL.iter_unpack(frame[offset:offset + count * _CELL.size])),
+                }
+                offset += count * _CELL.size
+            elif op == OP_HEAD:
+                _, pid, count = _HEAD.unpack_from(frame, offset)
+                offset += _HEAD.size
+                self.players[pid]['trail'].extend(_CELL.iter_unpack(frame[offset:offset + count * _CELL.size]))
+                offset += count * _CELL.size
+            elif op == OP_TAIL:
+                _, pid, count = _TAIL.unpack_from(frame, offset)
+                offset += _TAIL.size
+                trail = self.players[pid]['trail']
+                for _ in range(min(count, len(trail))):
+                    trail.popleft()
+            elif op in (OP_DEAD, OP_LEAVE, OP_POWERUP_REMOVE, OP_PORTAL_REMOVE):
+                _, key = _ID.unpack_from(frame, offset)
+                offset += _ID.size
+                if op == OP_DEAD:
+                    self.players[key]['dead'] = True
+                elif op == OP_LEAVE:
+                    self.players.pop(key, None)
+                elif op == OP_POWERUP_REMOVE:
+                    self.powerups.pop(key, None)
+                else:
+                    self.portals.pop(key, None)
+            elif op == OP_POWERUP:
+                _, uid, x, y, kind, r, g, b = _POWERUP.unpack_from(frame, offset)
+                offset += _POWERUP.size
+                self.powerups[uid] = {'position': (x, y), 'kind': kind, 'color': (r, g, b)}
+            elif op == OP_PORTAL:
+                _, uid, x, y, direction, r, g, b = _PORTAL.unpack_from(frame, offset)
+                offset += _PORTAL.size
+                self.portals[uid] = {'position': (x, y), 'direction': DIRECTIONS[direction],
+                                     'color': (r, g, b)}
+            else:
+                raise ValueError("Unknown spectator record {} at offset {}".format(op, offset))
+
+        return True
+
+    def draw(self, fb):
+        """
+        Draw the board as last received.
+        :param fb: A flaschen.Flaschen or anything with the same set() method
+        :return: None
+        """
+        for player in self.players.values():
+            for x, y in player['trail']:
+                fb.set(x, y, player['color'])
+
+        for powerup in self.powerups.values():
+            fb.set(*powerup['position'], powerup['color'])
+
+        for portal in self.portals.values():
+            x, y = portal['position']
+            if portal['direction'] in 'lr':
+                cells = [(x, y + n) for n in range(-2, 3)]
+            else:
+                cells = [(x + n, y) for n in range(-2, 3)]
+            for cell in cells:
+                fb.set(*cell, portal['color'])
@@ -0,0 +1,111 @@
+"""
+Crash recovery: save a snapshot mid-round, start a new game from it and check that it carries on.
+
+Run with `python -m pytest`.
+"""
+
+from collections import deque
+from types import SimpleNamespace
+import asyncio
+import time
+
+import game
+import loadgen
+
+
+class Session(loadgen.LoadTestComponent):
+    """A load test session that saves snapshots and gets its players back from the server."""
+
+    def __init__(self, snapshot_path, rejoin=()):
+        super().__init__()
+        self.snapshot_path = snapshot_path
+        self.rejoin = list(rejoin)
+        self.players = {}
+
+    async def call(self, procedure, *args, **kwargs):
+        return SimpleNamespace(results=[], kwresults={'players': self.rejoin})
+
+
+def make_player(badge_id, position, direction):
+    player = game.PlayerInfo(badge_id)
+    player.trail = deque([position])
+    player.direction = direction
+    return player
+
+
+async def save(path):
+    session = Session(path)
+    session.players = {badge_id: make_player(badge_id, (10, y), 'r')
+                       for badge_id, y in ((1, 5), (2, 15), (3, 25))}
+    session.powerups = [game.SpeedPowerup(20, 5)]
+    session.entities = []
+    session.phase = 'round'
+    session.next_powerup = time.time() + 5
+    session.powerup_count = 1
+    session.next_snapshot = 0
+    session.snapshot_write = None
+
+    for player in session.players.values():
+        for _ in range(3):
+            await player.move(session.players.values(), session.powerups, session.entities)
+
+    # Crashed this round; the round loop has already turned its lights off
+    dead = session.players[3]
+    dead.dead = True
+    dead.brightness = None
+
+    session.save_snapshot()
+    await session.snapshot_write
+    return {badge_id: list(player.trail) for badge_id, player in session.players.items()}
+
+
+async def restart(path, rejoin):
+    session = Session(path, rejoin)
+    task = asyncio.ensure_future(session.onJoin(None))
+    # Long enough to restore, rejoin everyone and play a few ticks of the round
+    await asyncio.sleep(.2)
+    try:
+        if task.done():
+            task.result()
+        return session
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+def test_resume_mid_round_with_a_dead_player(tmp_path):
+    path = str(tmp_path / 'game-state.pickle')
+    trails = asyncio.run(save(path))
+
+    session = asyncio.run(restart(path, [1, 2, 3]))
+
+    assert session.phase == 'round'
+    assert sorted(session.players) == [1, 2, 3]
+    assert all(player.subscriptions for player in session.players.values())
+
+    dead = session.players[3]
+    assert dead.dead and list(dead.trail) == trails[3]
+    # The living players kept moving from where they were
+    for badge_id in (1, 2):
+        trail = list(session.players[badge_id].trail)
+        assert trail[:len(trails[badge_id])] == trails[badge_id]
+        assert len(trail) > len(trails[badge_id])
+
+
+def test_players_who_dont_rejoin_are_dropped(tmp_path):
+    path = str(tmp_path / 'game-state.pickle')
+    asyncio.run(save(path))
+
+    session = asyncio.run(restart(path, [1, 2]))
+
+    assert sorted(session.players) == [1, 2]
+
+
+def test_bad_snapshot_starts_normally(tmp_path):
+    path = tmp_path / 'game-state.pickle'
+    path.write_bytes(b'not a snapshot')
+
+    session = asyncio.run(restart(str(path), [1]))
+
+    assert session.phase == 'waiting'
+    assert list(session.players) == [1]
@@ -0,0 +1,117 @@
+"""
+Round trip for the spectator stream: play a scripted game, feed every frame through a
+SpectatorView, and check that it always shows what the game has.
+
+Run with `python -m pytest`.
+"""
+
+from collections import deque
+import asyncio
+import random
+
+import game
+import spectator
+
+
+def make_player(badge_id, position, direction):
+    player = game.PlayerInfo(badge_id)
+    player.trail = deque([position])
+    player.direction = direction
+    return player
+
+
+class Match:
+    """A game's state plus a stream and a view following it."""
+
+    def __init__(self, players, powerups, keyframe_interval=16):
+        self.players = {player.badge_id: player for player in players}
+        self.powerups = powerups
+        self.entities = []
+        self.stream = spectator.SpectatorStream(game.WIDTH, game.HEIGHT, game.POWERUP_KINDS,
+                                                keyframe_interval, min_keyframe_gap=4)
+        self.view = spectator.SpectatorView()
+        self.frames = []
+
+    def tick(self):
+        for player in self.players.values():
+            asyncio.run(player.move(self.players.values(), self.powerups, self.entities))
+        self.send()
+
+    def send(self):
+        frame = self.stream.update(self.players, self.powerups, self.entities)
+        if frame is not None:
+            self.frames.append(frame)
+            assert self.view.apply(frame)
+        self.check()
+
+    def check(self):
+        view = self.view
+        assert (view.width, view.height) == (game.WIDTH, game.HEIGHT)
+
+        assert {p['name']: (list(p['trail']), p['dead'], p['color']) for p in view.players.values()} == \
+            {str(b): (list(p.trail), p.dead, game.hex_to_rgb(p.color)) for b, p in self.players.items()}
+
+        assert sorted((p['position'], game.POWERUP_KINDS[p['kind']], p['color']) for p in view.powerups.values()) == \
+            sorted((p.position, p.kind, game.hex_to_rgb(p.color)) for p in self.powerups if not p.consumed)
+
+        assert sorted((p['position'], p['direction'], p['color']) for p in view.portals.values()) == \
+            sorted((e.position, e.direction, game.hex_to_rgb(e.color)) for e in self.entities)
+
+
+def test_round_trip():
+    random.seed(1)
+    portal = game.PortalPowerup(14, 5)
+    match = Match([make_player(1, (10, 5), 'r'), make_player(2, (10, 20), 'r')],
+                  [portal, game.SpeedPowerup(20, 20), game.JumpPowerup(100, 30)])
+    player, other = match.players[1], match.players[2]
+    match.send()
+
+    # Pick up the portal powerup and place both ends of it
+    for _ in range(6):
+        match.tick()
+    assert player.powerup is portal
+    player.b()
+    for _ in range(3):
+        match.tick()
+    player.down()
+    match.tick()
+    player.a()
+    for _ in range(3):
+        match.tick()
+    assert len(match.entities) == 2 and len(match.view.portals) == 2
+
+    # Run until everyone has crashed, then eat the dead players' trails as the game does
+    while not all(p.dead for p in match.players.values()):
+        match.tick()
+    while not all(p.nommed() for p in match.players.values()):
+        for p in match.players.values():
+            p.nom()
+        match.send()
+
+    # A new round gives everyone a fresh trail and clears the board
+    match.powerups.clear()
+    match.entities.clear()
+    for p in match.players.values():
+        p.reset()
+    match.send()
+    for _ in range(5):
+        match.tick()
+
+    del match.players[other.badge_id]
+    match.send()
+    assert len(match.view.players) == 1
+
+    kinds = [frame[0] for frame in match.frames]
+    assert spectator.KEYFRAME in kinds[1:] and spectator.DELTA in kinds
+
+
+def test_requested_keyframes_are_rate_limited():
+    stream = spectator.SpectatorStream(game.WIDTH, game.HEIGHT, game.POWERUP_KINDS,
+                                       keyframe_interval=100, min_keyframe_gap=10)
+    keyframes = []
+    for n in range(50):
+        stream.request_keyframe()
+        frame = stream.update({}, [], [])
+        if frame is not None and frame[0] == spectator.KEYFRAME:
+            keyframes.append(n)
+    assert keyframes == [0, 10, 20, 30, 40]